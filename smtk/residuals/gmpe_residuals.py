@@ -25,14 +25,19 @@ from __future__ import print_function
 import sys
 import re
 import warnings
+import functools
+import multiprocessing
 import numpy as np
 from datetime import datetime
-from math import sqrt, ceil
-from scipy.special import erf
-from scipy.stats import norm
-from scipy.linalg import solve
-from copy import deepcopy
+from math import sqrt, ceil, log, log2, pi
+from scipy.special import erfc, ndtr
+from copy import copy, deepcopy
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from numba import njit
+except ImportError:  # numba is optional: fall back to numpy
+    njit = None
 from openquake.hazardlib.gsim import get_available_gsims
 from openquake.hazardlib.gsim.gmpe_table import GMPETable
 from openquake.hazardlib.gsim.base import GMPE
@@ -48,6 +53,103 @@ GSIM_KEYS = set(GSIM_LIST)
 # SCALAR_IMTS = ["PGA", "PGV", "PGD", "CAV", "Ia"]
 SCALAR_IMTS = ["PGA", "PGV"]
 STDDEV_KEYS = ["Mean", "Total", "Inter event", "Intra event"]
+INV_SQRT2 = 1.0 / sqrt(2.)
+INV_LN2 = 1.0 / log(2.)
+LOG2_2PI_HALF = 0.5 * log2(2. * pi)
+# Number of records per block in the vectorised EDR calculation
+EDR_BLOCK_SIZE = 1000
+# Matches GMPETable GSIM strings, e.g. GMPETable(gmpe_table='table.hdf5')
+_GMPETABLE_RE = re.compile(r'^GMPETable\(([^)]+?)\)$')
+
+
+def _random_effects_residuals(obs, mean, inter, intra, normalise):
+    """
+    Loop implementation of the random effects residuals (see
+    :meth:`Residuals._get_random_effects_residuals`), compiled with numba
+    when available. For the short record vectors of a single event this
+    avoids the dispatch and temporary arrays of the numpy expression
+    """
+    nvals = len(mean)
+    resid_sum = 0.0
+    for k in range(nvals):
+        resid_sum += obs[k] - mean[k]
+    inter_res = np.empty(nvals)
+    intra_res = np.empty(nvals)
+    for k in range(nvals):
+        inter_sq = inter[k] * inter[k]
+        inter_res[k] = (inter_sq * resid_sum) /\
+            (nvals * inter_sq + intra[k] * intra[k])
+        intra_res[k] = obs[k] - (mean[k] + inter_res[k])
+        if normalise:
+            inter_res[k] /= inter[k]
+            intra_res[k] /= intra[k]
+    return inter_res, intra_res
+
+
+def _distinctiveness_counts(outputs):
+    """
+    Returns, for each pair of GMPEs i, j and each IMT k, the number of
+    bootstraps in which GMPE i has the lower multivariate LLH minus the number
+    in which GMPE j has the lower multivariate LLH. Both counts are taken in
+    a single pass over the bootstraps, and compiled with numba when
+    available. The counts are antisymmetric, so only the pairs i < j are
+    compared
+    """
+    ngmpes, nimts, nbs = outputs.shape
+    counts = np.zeros((ngmpes, ngmpes, nimts))
+    for i in range(ngmpes):
+        for j in range(i + 1, ngmpes):
+            for k in range(nimts):
+                count = 0
+                for ib in range(nbs):
+                    if outputs[i, k, ib] < outputs[j, k, ib]:
+                        count += 1
+                    elif outputs[j, k, ib] < outputs[i, k, ib]:
+                        count -= 1
+                counts[i, j, k] = count
+                counts[j, i, k] = -count
+    return counts
+
+
+def _site_term_and_phi(intra_event):
+    """
+    Returns the site term dS2ss and the single-station phi of a site (see
+    :meth:`SingleStationAnalysis._get_delta_s2ss` and
+    :meth:`SingleStationAnalysis._get_single_station_phi`) from two loops
+    over the within-event residuals, compiled with numba when available
+    """
+    n_events = len(intra_event)
+    delta_s2ss = 0.0
+    for k in range(n_events):
+        delta_s2ss += intra_event[k]
+    delta_s2ss /= n_events
+    sum_sq = 0.0
+    for k in range(n_events):
+        diff = intra_event[k] - delta_s2ss
+        sum_sq += diff * diff
+    return delta_s2ss, np.sqrt(sum_sq / (n_events - 1))
+
+
+if njit is not None:
+    # numpy error model: zero sigmas give nan/inf rather than raising
+    # ZeroDivisionError, as in the numpy implementation
+    _random_effects_residuals = njit(cache=True, error_model="numpy")(
+        _random_effects_residuals)
+    # numpy error model: a single-record site gives a nan phi rather than
+    # raising ZeroDivisionError, as in the numpy implementation
+    _site_term_and_phi = njit(cache=True, error_model="numpy")(
+        _site_term_and_phi)
+    _distinctiveness_counts = njit(cache=True)(_distinctiveness_counts)
+
+
+@functools.lru_cache(maxsize=None)
+def _instantiate_gsim(gsim):
+    """
+    Returns an instance of the GSIM with the given name. Instances are cached,
+    so repeated Residuals objects for the same GSIMs do not re-run the GSIM
+    constructors
+    """
+    return GSIM_LIST[gsim]()
 
 
 def _check_gsim_list(gsim_list):
@@ -67,14 +169,15 @@ def _check_gsim_list(gsim_list):
             output_gsims.append((_get_gmpe_name(gsim), gsim))
         elif gsim.startswith("GMPETable"):
             # Get filename
-            match = re.match(r'^GMPETable\(([^)]+?)\)$', gsim)
-            filepath = match.group(1).split("=")[1]
-            gmpe_table = GMPETable(gmpe_table=filepath[1:-1])
+            match = _GMPETABLE_RE.match(gsim)
+            # Strip the surrounding quotes (if any) from the file path
+            filepath = match.group(1).split("=", 1)[1].strip().strip("'\"")
+            gmpe_table = GMPETable(gmpe_table=filepath)
             output_gsims.append((_get_gmpe_name(gmpe_table), gmpe_table))
         elif not (gsim in GSIM_LIST):
             raise ValueError('%s Not supported by OpenQuake' % gsim)
         else:
-            output_gsims.append((gsim, GSIM_LIST[gsim]()))
+            output_gsims.append((gsim, _instantiate_gsim(gsim)))
     return OrderedDict(output_gsims)
 
 
@@ -208,55 +311,83 @@ SPECTRA_FROM_FILE = {"Geometric": get_geometric_mean,
                      "GMRotD50": get_gmrotd50,
                      "RotD50": get_rotd50}
 
+
+def _concatenate(arrays):
+    """
+    Concatenates a list of 1D arrays, returning an empty array if the list
+    is empty
+    """
+    if not len(arrays):
+        return np.array([])
+    return np.concatenate(arrays)
+
+
 # The following methods are used for the MultivariateLLH function
-def _build_matrices(contexts, gmpe, imtx):
+def _build_vectors(contexts, gmpe, imtx):
     """
-    Constructs the R and Z_G matrices (based on the implementation
-    in the supplement to Mak et al (2017)
+    Returns the log observations, expected means and the diagonal of the R
+    matrix for all records, together with the non-zero entries of the Z_G
+    matrix (one per record) and the index of the event (column of Z_G) to
+    which each record belongs
     """
     neqs = len(contexts)
-    nrecs = sum([ctxt["Num. Sites"] for ctxt in contexts])
-
-    r_mat = np.zeros(nrecs, dtype=float)
-    z_g_mat = np.zeros([nrecs, neqs], dtype=float)
-    expected_mat = np.zeros(nrecs, dtype=float)
-    # Get observations
-    observations = np.zeros(nrecs)
-    i = 0
-    # Determine the total number of records and pass the log of the
-    # obserations to the observations dictionary
+    # Pass the log of the observations to the observations vector
+    observations = np.concatenate([np.log(ctxt["Observations"][imtx])
+                                   for ctxt in contexts])
+    r_parts = []
+    mean_parts = []
+    inter_parts = []
     for ctxt in contexts:
-        n_s = ctxt["Num. Sites"]
-        observations[i:(i + n_s)] = np.log(ctxt["Observations"][imtx])
-        i += n_s
-
-    i = 0
-    for j, ctxt in enumerate(contexts):
-        if not("Intra event" in ctxt["Expected"][gmpe][imtx]) and\
-                not("Inter event" in ctxt["Expected"][gmpe][imtx]):
+        expected = ctxt["Expected"][gmpe][imtx]
+        mean_parts.append(expected["Mean"])
+        if not("Intra event" in expected) and\
+                not("Inter event" in expected):
             # Only the total sigma exists
             # Total sigma is used as intra-event sigma (from S. Mak)
-            n_r = len(ctxt["Expected"][gmpe][imtx]["Total"])
-            r_mat[i:(i + n_r)] = ctxt["Expected"][gmpe][imtx]["Total"]
-            expected_mat[i:(i + n_r)] = ctxt["Expected"][gmpe][imtx]["Mean"]
+            r_parts.append(expected["Total"])
             # Inter-event sigma is set to 0
-            i += n_r
+            inter_parts.append(np.zeros(len(expected["Total"])))
             continue
-        n_r = len(ctxt["Expected"][gmpe][imtx]["Intra event"])
-        r_mat[i:(i + n_r)] = ctxt["Expected"][gmpe][imtx]["Intra event"]
-        # Get expected mean
-        expected_mat[i:(i + n_r)] = ctxt["Expected"][gmpe][imtx]["Mean"]
-        if len(ctxt["Expected"][gmpe][imtx]["Inter event"]) == 1:
+        n_r = len(expected["Intra event"])
+        r_parts.append(expected["Intra event"])
+        if len(expected["Inter event"]) == 1:
             # Single inter event residual
-            z_g_mat[i:(i + n_r), j] =\
-                ctxt["Expected"][gmpe][imtx]["Inter event"][0]
+            inter_parts.append(expected["Inter event"][0] * np.ones(n_r))
         else:
             # inter-event residual given at a vector
-            z_g_mat[i:(i + n_r), j] =\
-                ctxt["Expected"][gmpe][imtx]["Inter event"]
-        i += n_r
+            inter_parts.append(expected["Inter event"])
+    r_mat = np.concatenate(r_parts)
+    expected_mat = np.concatenate(mean_parts)
+    z_g_vec = np.concatenate(inter_parts)
+    nrecs = len(r_mat)
+    n_rs = np.array([len(r_part) for r_part in r_parts])
+    col_idx = np.repeat(np.arange(neqs), n_rs)
+    return observations, expected_mat, r_mat, z_g_vec, col_idx, neqs, nrecs
+
 
-    v_mat = np.diag(r_mat ** 2.) + z_g_mat.dot(z_g_mat.T)
+def _build_matrices(contexts, gmpe, imtx):
+    """
+    Constructs the R and Z_G matrices (based on the implementation
+    in the supplement to Mak et al (2017)
+
+    The dense covariance matrix is not needed by :func:`get_multivariate_ll`
+    and is kept as a reference implementation
+    """
+    observations, expected_mat, r_mat, z_g_vec, col_idx, neqs, nrecs =\
+        _build_vectors(contexts, gmpe, imtx)
+    # Each record loads only onto the Z_G column of its own event, so
+    # Z_G Z_G^T is zero outside the diagonal blocks of the events. Each block
+    # is the outer product of the non-zero entries of its event - Z_G itself
+    # is never formed. The records of each event are contiguous
+    v_mat = np.zeros((nrecs, nrecs))
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(col_idx,
+                                                        minlength=neqs))])
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        v_mat[start:stop, start:stop] = np.outer(z_g_vec[start:stop],
+                                                 z_g_vec[start:stop])
+    # Add R^2 to the diagonal in place rather than building diag(R^2)
+    idx = np.arange(nrecs)
+    v_mat[idx, idx] += np.square(r_mat)
     return observations, v_mat, expected_mat, neqs, nrecs
 
 
@@ -265,31 +396,156 @@ def get_multivariate_ll(contexts, gmpe, imt):
     Returns the multivariate loglikelihood, as described om equation 7 of
     Mak et al. (2017)
     """
-    observations, v_mat, expected_mat, neqs, nrecs = _build_matrices(
-        contexts, gmpe, imt)
-    sign, logdetv = np.linalg.slogdet(v_mat)
+    return get_multivariate_ll_imts(contexts, gmpe, [imt])[0]
+
+
+def get_multivariate_ll_imts(contexts, gmpe, imts):
+    """
+    Returns the multivariate loglikelihood (see :func:`get_multivariate_ll`)
+    for each IMT in a list
+
+    As each record loads only onto the Z_G column of its own event, the
+    covariance matrix V = R^2 + Z_G Z_G^T is block diagonal by event and
+    each block is a rank-one update of a diagonal matrix. The
+    log-determinant and b^T V^-1 b are therefore accumulated event by event
+    using the Sherman-Morrison formula, without forming V. The records and
+    events are the same for all IMTs, so the vectors of the IMTs are stacked
+    into [nimts, nrecs] arrays and the event sums of all IMTs are taken at
+    once
+
+    :returns:
+        Multivariate loglikelihood of each IMT as a 1D array
+    """
+    vectors = [_build_vectors(contexts, gmpe, imtx) for imtx in imts]
+    col_idx, neqs, nrecs = vectors[0][4:]
+    observations, expected_mat, r_mat, z_g_vec = [
+        np.stack([vec[i] for vec in vectors]) for i in range(4)]
+    nimts = len(imts)
     b_mat = observations - expected_mat
-    return (float(nrecs) * np.log(2.0 * np.pi) + logdetv +
-            (b_mat.T.dot(solve(v_mat, b_mat)))) / 2.
+    inv_r2 = 1.0 / np.square(r_mat)
+    # Per-event sums of z^2 / r^2 and z * b / r^2, with the events of IMT k
+    # numbered from k * neqs
+    imt_idx = (col_idx + neqs * np.arange(nimts)[:, np.newaxis]).ravel()
+    zz_sum = np.bincount(imt_idx,
+                         weights=(np.square(z_g_vec) * inv_r2).ravel(),
+                         minlength=nimts * neqs).reshape(nimts, neqs)
+    zb_sum = np.bincount(imt_idx, weights=(z_g_vec * b_mat * inv_r2).ravel(),
+                         minlength=nimts * neqs).reshape(nimts, neqs)
+    logdetv = -np.sum(np.log(inv_r2), axis=1) +\
+        np.sum(np.log1p(zz_sum), axis=1)
+    btvb = np.sum(np.square(b_mat) * inv_r2, axis=1) -\
+        np.sum(np.square(zb_sum) / (1.0 + zz_sum), axis=1)
+    return (float(nrecs) * np.log(2.0 * np.pi) + logdetv + btvb) / 2.
+
+
+def get_bootstrap_samples(number_bootstraps, neqs, seed=None):
+    """
+    Draws the events sampled (with replacement) in each cluster bootstrap
+
+    :param int seed:
+        Seed of a new random number generator. If None the samples are
+        drawn from numpy's global random state (so `np.random.seed` still
+        makes them reproducible)
+    :returns:
+        Indices of the sampled events as an integer array of shape
+        [number_bootstraps, neqs]
+    """
+    if seed is None:
+        return np.random.randint(0, neqs, size=(number_bootstraps, neqs))
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, neqs, size=(number_bootstraps, neqs))
 
 
-def bootstrap_llh(ij, contexts, gmpes, imts):
+def bootstrap_llh(ij, contexts, gmpes, imts, isamp=None, verbose=True):
     """
     Applyies the cluster bootstrap. A set of events, equal in length to that
     of the original data, is sampled randomly from the list of contexts. All of
     the sigmas for that specific event are transfered to the sample
+
+    :param isamp:
+        Indices of the sampled events (see :func:`get_bootstrap_samples`). If
+        None the events are sampled here from numpy's global random state
+    :param bool verbose:
+        If True prints the time taken by the bootstrap
     """
     # Sample contexts
     timer_on = datetime.now()
-    neqs = len(contexts)
-    isamp = np.random.randint(0, neqs, neqs)
+    if isamp is None:
+        isamp = get_bootstrap_samples(1, len(contexts))[0]
     new_contexts = [contexts[i] for i in isamp]
     outputs = np.zeros([len(gmpes), len(imts)])
     for i, gmpe in enumerate(gmpes):
-        for j, imtx in enumerate(imts):
-            outputs[i, j] = get_multivariate_ll(new_contexts, gmpe, imtx)
-    print("Bootstrap completed in {:.2f} seconds".format(
-        (datetime.now() - timer_on).total_seconds()))
+        outputs[i, :] = get_multivariate_ll_imts(new_contexts, gmpe, imts)
+    if verbose:
+        print("Bootstrap completed in {:.2f} seconds".format(
+            (datetime.now() - timer_on).total_seconds()))
+    return outputs
+
+
+# Data shared by all bootstraps run in a worker process
+_BOOTSTRAP_DATA = {}
+
+
+def _init_bootstrap_worker(contexts, gmpes, imts):
+    """
+    Stores the contexts, GMPEs and IMTs in the worker process, so that they
+    are pickled once per worker rather than once per bootstrap
+    """
+    _BOOTSTRAP_DATA["contexts"] = contexts
+    _BOOTSTRAP_DATA["gmpes"] = gmpes
+    _BOOTSTRAP_DATA["imts"] = imts
+
+
+def _bootstrap_llh_worker(ij, isamp):
+    """
+    Runs a single bootstrap on the data stored in the worker process. Nothing
+    is printed, as the output of the workers would interleave
+    """
+    return bootstrap_llh(ij, _BOOTSTRAP_DATA["contexts"],
+                         _BOOTSTRAP_DATA["gmpes"], _BOOTSTRAP_DATA["imts"],
+                         isamp, verbose=False)
+
+
+def bootstrap_llh_batch(number_bootstraps, contexts, gmpes, imts,
+                        concurrent_tasks=None, seed=None):
+    """
+    Runs a set of cluster bootstraps (see :func:`bootstrap_llh`) in parallel
+    over a pool of processes
+
+    The worker processes are started with the "spawn" method, which
+    re-imports the calling script's `__main__` module in every worker. A
+    script calling this function (directly or through
+    :meth:`Residuals.bootstrap_multivariate_llhvalues`) must therefore do so
+    under an `if __name__ == "__main__":` guard
+
+    :param int number_bootstraps:
+        Number of bootstrap samples
+    :param int concurrent_tasks:
+        Number of worker processes (if None uses the number of processors)
+    :param int seed:
+        Seed of the random number generator used to sample the events
+    :returns:
+        Multivariate LLH values as an array of shape
+        [len(gmpes), len(imts), number_bootstraps]
+    """
+    timer_on = datetime.now()
+    # All samples are drawn here, so the workers need no random state
+    samples = get_bootstrap_samples(number_bootstraps, len(contexts), seed)
+    # Fortran order makes the [ngmpes, nimts] slice written by each bootstrap
+    # contiguous
+    outputs = np.zeros([len(gmpes), len(imts), number_bootstraps], order="F")
+    # Workers are spawned rather than forked: forking a process in which
+    # numba has started its threading layer can deadlock
+    with ProcessPoolExecutor(max_workers=concurrent_tasks,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_bootstrap_worker,
+                             initargs=(contexts, list(gmpes), imts)) as pool:
+        for j, output in enumerate(pool.map(_bootstrap_llh_worker,
+                                            range(number_bootstraps),
+                                            samples)):
+            outputs[:, :, j] = output
+    print("{:g} bootstraps completed in {:.2f} seconds".format(
+        number_bootstraps, (datetime.now() - timer_on).total_seconds()))
     return outputs
 
 
@@ -307,38 +563,47 @@ class Residuals(object):
         """
         self.gmpe_list = _check_gsim_list(gmpe_list)
         self.number_gmpes = len(self.gmpe_list)
-        self.types = OrderedDict([(gmpe, {}) for gmpe in self.gmpe_list])
+        self.types = {gmpe: {} for gmpe in self.gmpe_list}
         self.residuals = []
         self.modelled = []
         self.imts = imts
+        # Parse the IMT strings once - they are re-used for every context
+        self._imt_objs = {imtx: imt.from_string(imtx) for imtx in imts}
+        self._imt_periods = {
+            imtx: (self._imt_objs[imtx].period if "SA(" in imtx else None)
+            for imtx in imts}
         self.unique_indices = {}
         self.gmpe_sa_limits = {}
         self.gmpe_scalars = {}
+        # Whether each IMT is within the period range of each GMPE
+        self._imt_valid = {}
         for gmpe in self.gmpe_list:
-            gmpe_dict_1 = OrderedDict([])
-            gmpe_dict_2 = OrderedDict([])
+            gmpe_dict_1 = {}
+            gmpe_dict_2 = {}
             self.unique_indices[gmpe] = {}
+            self._imt_valid[gmpe] = {}
             # Get the period range and the coefficient types
             # gmpe_i = GSIM_LIST[gmpe]()
             gmpe_i = self.gmpe_list[gmpe]
-            for c in dir(gmpe_i):
-                if 'COEFFS' in c:
-                    pers = [sa.period for sa in getattr(gmpe_i, c).sa_coeffs]
+            # The period range and scalar IMTs come from the last coefficient
+            # table (in attribute order)
+            coeffs_attrs = [c for c in dir(gmpe_i) if 'COEFFS' in c]
+            coeffs = getattr(gmpe_i, coeffs_attrs[-1])
+            pers = [sa.period for sa in coeffs.sa_coeffs]
             min_per, max_per = (min(pers), max(pers))
             self.gmpe_sa_limits[gmpe] = (min_per, max_per)
-            for c in dir(gmpe_i):
-                if 'COEFFS' in c:
-                    self.gmpe_scalars[gmpe] = list(
-                        getattr(gmpe_i, c).non_sa_coeffs.keys())
+            self.gmpe_scalars[gmpe] = list(coeffs.non_sa_coeffs.keys())
             for imtx in self.imts:
                 if "SA(" in imtx:
-                    period = imt.from_string(imtx).period
+                    period = self._imt_periods[imtx]
                     if period < min_per or period > max_per:
                         print("IMT %s outside period range for GMPE %s"
                               % (imtx, gmpe))
                         gmpe_dict_1[imtx] = None
                         gmpe_dict_2[imtx] = None
+                        self._imt_valid[gmpe][imtx] = False
                         continue
+                self._imt_valid[gmpe][imtx] = True
                 gmpe_dict_1[imtx] = {}
                 gmpe_dict_2[imtx] = {}
                 self.unique_indices[gmpe][imtx] = []
@@ -355,6 +620,9 @@ class Residuals(object):
         self.modelled = OrderedDict(self.modelled)
         self.number_records = None
         self.contexts = None
+        # Log observations of all records (in context order) for each IMT,
+        # built from the contexts when first needed
+        self.log_observations = None
 
     def get_residuals(self, database, nodal_plane_index=1,
                       component="Geometric", normalise=True):
@@ -377,6 +645,7 @@ class Residuals(object):
 
         # Contexts is in either case a list of dictionaries
         self.contexts = []
+        self.log_observations = None
         for context in contexts:
 
             # convert all IMTS with acceleration units, which are supposed to
@@ -393,34 +662,33 @@ class Residuals(object):
                 for imtx in self.residuals[gmpe].keys():
                     if not context["Residual"][gmpe][imtx]:
                         continue
-                    for res_type in self.residuals[gmpe][imtx].keys():
+                    # Residuals are accumulated as lists of arrays (one per
+                    # context) and concatenated once all contexts are done
+                    res_dict = self.residuals[gmpe][imtx]
+                    mod_dict = self.modelled[gmpe][imtx]
+                    ctx_res = context["Residual"][gmpe][imtx]
+                    ctx_exp = context["Expected"][gmpe][imtx]
+                    for res_type in res_dict.keys():
                         if res_type == "Inter event":
-                            inter_ev = \
-                                context["Residual"][gmpe][imtx][res_type]
-                            if np.all(
-                                    np.fabs(inter_ev - inter_ev[0]) < 1.0E-12):
+                            inter_ev = ctx_res[res_type]
+                            if inter_ev.size == 1 or\
+                                    np.ptp(inter_ev) < 1.0E-12:
                                 # Single inter-event residual
-                                self.residuals[gmpe][imtx][res_type].append(
-                                    inter_ev[0])
+                                res_dict[res_type].append(inter_ev[:1])
                                 # Append indices
                                 self.unique_indices[gmpe][imtx].append(
                                     np.array([0]))
                             else:
                                 # Inter event residuals per-site e.g. Chiou
                                 # & Youngs (2008; 2014) case
-                                self.residuals[gmpe][imtx][res_type].extend(
-                                    inter_ev.tolist())
+                                res_dict[res_type].append(inter_ev)
                                 self.unique_indices[gmpe][imtx].append(
                                     np.arange(len(inter_ev)))
                         else:
-                            self.residuals[gmpe][imtx][res_type].extend(
-                                context["Residual"][gmpe][imtx][res_type].
-                                tolist())
-                        self.modelled[gmpe][imtx][res_type].extend(
-                            context["Expected"][gmpe][imtx][res_type].tolist())
+                            res_dict[res_type].append(ctx_res[res_type])
+                        mod_dict[res_type].append(ctx_exp[res_type])
 
-                    self.modelled[gmpe][imtx]["Mean"].extend(
-                        context["Expected"][gmpe][imtx]["Mean"].tolist())
+                    mod_dict["Mean"].append(ctx_exp["Mean"])
 
             self.contexts.append(context)
 
@@ -428,13 +696,12 @@ class Residuals(object):
             for imtx in self.residuals[gmpe].keys():
                 if not self.residuals[gmpe][imtx]:
                     continue
-                for res_type in self.residuals[gmpe][imtx].keys():
-                    self.residuals[gmpe][imtx][res_type] = np.array(
-                        self.residuals[gmpe][imtx][res_type])
-                    self.modelled[gmpe][imtx][res_type] = np.array(
-                        self.modelled[gmpe][imtx][res_type])
-                self.modelled[gmpe][imtx]["Mean"] = np.array(
-                    self.modelled[gmpe][imtx]["Mean"])
+                res_dict = self.residuals[gmpe][imtx]
+                mod_dict = self.modelled[gmpe][imtx]
+                for res_type in res_dict.keys():
+                    res_dict[res_type] = _concatenate(res_dict[res_type])
+                    mod_dict[res_type] = _concatenate(mod_dict[res_type])
+                mod_dict["Mean"] = _concatenate(mod_dict["Mean"])
 
     def get_expected_motions(self, context):
         """
@@ -443,23 +710,20 @@ class Residuals(object):
         # TODO Rake hack will be removed!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         if not context["Ctx"].rake:
             context["Ctx"].rake = 0.0
-        expected = OrderedDict([(gmpe, {}) for gmpe in self.gmpe_list])
+        expected = {}
         # Period range for GSIM
         for gmpe in self.gmpe_list:
-            expected[gmpe] = OrderedDict([(imtx, {}) for imtx in self.imts])
+            expected[gmpe] = {imtx: {} for imtx in self.imts}
+            gsim = self.gmpe_list[gmpe]
             for imtx in self.imts:
-                gsim = self.gmpe_list[gmpe]
-                if "SA(" in imtx:
-                    period = imt.from_string(imtx).period
-                    if period < self.gmpe_sa_limits[gmpe][0] or\
-                            period > self.gmpe_sa_limits[gmpe][1]:
-                        expected[gmpe][imtx] = None
-                        continue
+                if not self._imt_valid[gmpe][imtx]:
+                    expected[gmpe][imtx] = None
+                    continue
                 mean, stddev = gsim.get_mean_and_stddevs(
                     context["Ctx"],
                     context["Ctx"],
                     context["Ctx"],
-                    imt.from_string(imtx),
+                    self._imt_objs[imtx],
                     self.types[gmpe][imtx])
                 expected[gmpe][imtx]["Mean"] = mean
                 for i, res_type in enumerate(self.types[gmpe][imtx]):
@@ -472,25 +736,32 @@ class Residuals(object):
         """
         Calculate the residual terms
         """
+        # The log observations are common to all GMPEs
+        log_obs = {imtx: np.log(context["Observations"][imtx])
+                   for imtx in self.imts}
         # Calculate residual
         residual = {}
         for gmpe in self.gmpe_list:
-            residual[gmpe] = OrderedDict([])
+            residual[gmpe] = {}
             for imtx in self.imts:
                 residual[gmpe][imtx] = {}
-                obs = np.log(context["Observations"][imtx])
-                if not context["Expected"][gmpe][imtx]:
+                obs = log_obs[imtx]
+                ctx_exp = context["Expected"][gmpe][imtx]
+                if not ctx_exp:
                     residual[gmpe][imtx] = None
                     continue
-                mean = context["Expected"][gmpe][imtx]["Mean"]
-                total_stddev = context["Expected"][gmpe][imtx]["Total"]
-                residual[gmpe][imtx]["Total"] = (obs - mean) / total_stddev
+                mean = ctx_exp["Mean"]
+                total_stddev = ctx_exp["Total"]
+                # Divide in place to avoid a second temporary array
+                total_res = np.subtract(obs, mean)
+                np.divide(total_res, total_stddev, out=total_res)
+                residual[gmpe][imtx]["Total"] = total_res
                 if "Inter event" in self.residuals[gmpe][imtx].keys():
                     inter, intra = self._get_random_effects_residuals(
                         obs,
                         mean,
-                        context["Expected"][gmpe][imtx]["Inter event"],
-                        context["Expected"][gmpe][imtx]["Intra event"],
+                        ctx_exp["Inter event"],
+                        ctx_exp["Intra event"],
                         normalise)
                     residual[gmpe][imtx]["Inter event"] = inter
                     residual[gmpe][imtx]["Intra event"] = intra
@@ -503,10 +774,18 @@ class Residuals(object):
         Calculates the random effects residuals using the inter-event
         residual formula described in Abrahamson & Youngs (1992) Eq. 10
         """
+        if njit is not None:
+            # The kernel indexes the sigmas per record, so broadcast
+            # single-valued sigmas to the number of records
+            return _random_effects_residuals(
+                obs, mean, np.broadcast_to(inter, mean.shape),
+                np.broadcast_to(intra, mean.shape), normalise)
         nvals = float(len(mean))
-        inter_res = ((inter ** 2.) * sum(obs - mean)) /\
-            (nvals * (inter ** 2.) + (intra ** 2.))
-        intra_res = obs - (mean + inter_res)
+        intra_res = np.subtract(obs, mean)
+        inter_sq = np.square(inter)
+        inter_res = (inter_sq * intra_res.sum()) /\
+            (nvals * inter_sq + np.square(intra))
+        intra_res -= inter_res
         if normalise:
             return inter_res / inter, intra_res / intra
         return inter_res, intra_res
@@ -585,35 +864,35 @@ class Residuals(object):
             for key, val in event["Rupture"].__dict__.items()])
         fid.write("Rupture: %s %s %s\n" % (str(event["EventID"]), sep,
                                            rupture_str))
+        # Resolve the format and array of each column once for all records
+        columns = []
+        # Distances
+        for key in event["Distances"].__dict__:
+            columns.append(("{:.4f}".format,
+                            getattr(event["Distances"], key)))
+        # Sites
+        for key in event["Sites"].__dict__:
+            columns.append(("{:.4f}".format, getattr(event["Sites"], key)))
+        # Observations
+        for imtx in self.imts:
+            columns.append(("{:.8e}".format, event["Observations"][imtx]))
+        # Expected
+        for imtx in self.imts:
+            for gmpe in self.gmpe_list:
+                if not event["Expected"][gmpe][imtx]:
+                    continue
+                for key, values in event["Expected"][gmpe][imtx].items():
+                    columns.append(("{:.8e}".format, values))
+        # Residuals
+        for imtx in self.imts:
+            for gmpe in self.gmpe_list:
+                if not event["Expected"][gmpe][imtx]:
+                    continue
+                for key, values in event["Residual"][gmpe][imtx].items():
+                    columns.append(("{:.8e}".format, values))
         # For each record
         for i in range(event["Num. Sites"]):
-            data = []
-            # Distances
-            for key in event["Distances"].__dict__:
-                data.append("{:.4f}".format(
-                    getattr(event["Distances"], key)[i]))
-            # Sites
-            for key in event["Sites"].__dict__:
-                data.append("{:.4f}".format(getattr(event["Sites"], key)[i]))
-            # Observations
-            for imtx in self.imts:
-                data.append("{:.8e}".format(event["Observations"][imtx][i]))
-            # Expected
-            for imtx in self.imts:
-                for gmpe in self.gmpe_list:
-                    if not event["Expected"][gmpe][imtx]:
-                        continue
-                    for key in event["Expected"][gmpe][imtx].keys():
-                        data.append("{:.8e}".format(
-                            event["Expected"][gmpe][imtx][key][i]))
-            # Residuals
-            for imtx in self.imts:
-                for gmpe in self.gmpe_list:
-                    if not event["Expected"][gmpe][imtx]:
-                        continue
-                    for key in event["Residual"][gmpe][imtx].keys():
-                        data.append("{:.8e}".format(
-                            event["Residual"][gmpe][imtx][key][i]))
+            data = [fmt(values[i]) for fmt, values in columns]
             self._extend_data_print(data, event, i)
             fid.write("%s\n" % sep.join(data))
 
@@ -636,12 +915,10 @@ class Residuals(object):
         Returns an array of magnitudes equal in length to the number of
         residuals
         """
-        magnitudes = np.array([])
-        for ctxt in self.contexts:
-            magnitudes = np.hstack([
-                magnitudes,
-                ctxt["Ctx"].mag * np.ones(len(ctxt["Ctx"].repi))])
-        return magnitudes
+        sizes = [len(ctxt["Ctx"].repi) for ctxt in self.contexts]
+        return np.repeat(
+            np.array([ctxt["Ctx"].mag for ctxt in self.contexts], dtype=float),
+            sizes)
 
     def get_likelihood_values(self):
         """
@@ -682,7 +959,7 @@ class Residuals(object):
         ret = {}
         for res_type in self.types[gmpe][imt]:
             zvals = np.fabs(self.residuals[gmpe][imt][res_type])
-            l_h = 1.0 - erf(zvals / sqrt(2.))
+            l_h = erfc(zvals * INV_SQRT2)
             median_lh = np.nanpercentile(l_h, 50.0)
             ret[res_type] = l_h, median_lh
         return ret
@@ -698,8 +975,8 @@ class Residuals(object):
         :param imts:
             List of intensity measures for LLH calculation
         """
-        log_residuals = OrderedDict([(gmpe, np.array([]))
-                                     for gmpe in self.gmpe_list])
+        # Log-likelihoods of each IMT, concatenated once per GMPE
+        log_residuals = {gmpe: [] for gmpe in self.gmpe_list}
         imt_list = [(imtx, None) for imtx in imts]
         imt_list.append(("All", None))
         llh = OrderedDict([(gmpe, OrderedDict(imt_list))
@@ -711,16 +988,14 @@ class Residuals(object):
                           % (imtx, gmpe))
                     continue
                 # Get log-likelihood distance for IMT
-                asll = np.log2(norm.pdf(self.residuals[gmpe][imtx]["Total"],
-                               0.,
-                               1.0))
-                log_residuals[gmpe] = np.hstack([
-                    log_residuals[gmpe],
-                    asll])
+                # log2 of the standard normal pdf, in closed form
+                total_res = self.residuals[gmpe][imtx]["Total"]
+                asll = -0.5 * INV_LN2 * np.square(total_res) - LOG2_2PI_HALF
+                log_residuals[gmpe].append(asll)
                 llh[gmpe][imtx] = -(1.0 / float(len(asll))) * np.sum(asll)
 
-            llh[gmpe]["All"] = -(1. / float(len(log_residuals[gmpe]))) *\
-                np.sum(log_residuals[gmpe])
+            all_asll = _concatenate(log_residuals[gmpe])
+            llh[gmpe]["All"] = -(1. / float(len(all_asll))) * np.sum(all_asll)
         # Get weights
         weights = np.array([2.0 ** -llh[gmpe]["All"]
                             for gmpe in self.gmpe_list])
@@ -750,29 +1025,37 @@ class Residuals(object):
         # Get number of events and records
         for gmpe in self.gmpe_list:
             print("GMPE = {:s}".format(gmpe))
-            for j, imtx in enumerate(self.imts):
-                if self.residuals[gmpe][imtx] is None:
-                    # IMT missing for this GMPE
-                    multi_llh_values[gmpe][imtx] = 0.0
-                else:
-                    multi_llh_values[gmpe][imtx] = get_multivariate_ll(
-                        self.contexts, gmpe, imtx)
+            # IMTs missing for this GMPE are given 0.0, the others are
+            # evaluated together
+            imts_ok = [imtx for imtx in self.imts
+                       if self.residuals[gmpe][imtx] is not None]
+            llh_ok = {}
+            if imts_ok:
+                llh_ok = dict(zip(imts_ok, get_multivariate_ll_imts(
+                    self.contexts, gmpe, imts_ok)))
+            for imtx in self.imts:
+                multi_llh_values[gmpe][imtx] = llh_ok.get(imtx, 0.0)
             if sum_imts:
-                total_llh = 0.0
-                for imtx in self.imts:
-                    if np.isnan(multi_llh_values[gmpe][imtx]):
-                        continue
-                    total_llh += multi_llh_values[gmpe][imtx]
-                multi_llh_values[gmpe] = total_llh
+                # Sum over the IMTs, ignoring any NaN values
+                multi_llh_values[gmpe] = np.nansum(np.array(
+                    [multi_llh_values[gmpe][imtx] for imtx in self.imts],
+                    dtype=float))
         return multi_llh_values
 
     def bootstrap_multivariate_llhvalues(self, number_bootstraps,
                                          sum_imts=False, parallelize=False,
-                                         concurrent_tasks=8):
+                                         concurrent_tasks=8, seed=None):
         """
         Bootstrap the analysis using cluster sampling, as describe in Mak et
-        al. 2017. OpenQuake's :class: `openquake.baselib.parallel.Starmap`
-        utility is invoked to parallelise the calculations by bootstrap
+        al. 2017. If `parallelize` is True the bootstraps are distributed
+        over `concurrent_tasks` spawned processes (see
+        :func:`bootstrap_llh_batch`), so a script using it must make the call
+        under an `if __name__ == "__main__":` guard.
+
+        The events are sampled in this process, from a generator seeded with
+        `seed` or, if `seed` is None, from numpy's global random state. Either
+        way the same seed gives the same bootstraps whether or not they are
+        run in parallel
         """
         # Setup multivariate log-likelihood dict
         multi_llh_values = []
@@ -781,18 +1064,26 @@ class Residuals(object):
             for j, imtx in enumerate(self.imts):
                 nmods.append((i, j))
                 multi_llh_values.append((gmpe, imtx))
-        outputs = np.zeros([len(self.gmpe_list), len(self.imts),
-                            number_bootstraps])
         if parallelize:
-            raise NotImplementedError("Parellelisation not turned on yet!")
+            outputs = bootstrap_llh_batch(number_bootstraps,
+                                          self.contexts,
+                                          self.gmpe_list,
+                                          self.imts,
+                                          concurrent_tasks,
+                                          seed)
         else:
+            samples = get_bootstrap_samples(number_bootstraps,
+                                            len(self.contexts), seed)
+            outputs = np.zeros([len(self.gmpe_list), len(self.imts),
+                                number_bootstraps], order="F")
             for j in range(number_bootstraps):
                 print("Bootstrap {:g} of {:g}".format(j + 1,
                       number_bootstraps))
                 outputs[:, :, j] = bootstrap_llh(j,
                                                  self.contexts,
                                                  self.gmpe_list,
-                                                 self.imts)
+                                                 self.imts,
+                                                 samples[j])
         distinctiveness = self.get_distinctiveness(outputs,
                                                    number_bootstraps,
                                                    sum_imts)
@@ -803,34 +1094,29 @@ class Residuals(object):
         Return the distinctiveness index as described in equation 9 of Mak
         et al. (2017)
         """
-        ngmpes = len(self.gmpe_list)
         nbs = float(number_bootstraps)
         nimts = float(len(self.imts))
+        # The bootstrap axis is read innermost, but the bootstrap drivers
+        # write the outputs in Fortran order - read from a C-ordered copy
+        outputs = np.ascontiguousarray(outputs)
+        if njit is not None:
+            counts = _distinctiveness_counts(outputs)
+        else:
+            # Broadcast the comparison over the pairs of GMPEs i < j (the
+            # counts are antisymmetric) - wins[p, k] is the number of
+            # bootstraps in which the first GMPE of pair p has the lower
+            # multivariate LLH for IMT k
+            iloc, jloc = np.triu_indices(len(outputs), 1)
+            wins = np.sum(outputs[iloc] < outputs[jloc], axis=-1, dtype=float)
+            losses = np.sum(outputs[jloc] < outputs[iloc], axis=-1,
+                            dtype=float)
+            counts = np.zeros((len(outputs), len(outputs), outputs.shape[1]))
+            counts[iloc, jloc] = wins - losses
+            counts[jloc, iloc] = losses - wins
         if sum_imts:
-            distinctiveness = np.zeros([ngmpes, ngmpes])
             # Get only one index for each GMPE
-            for i, gmpe in enumerate(self.gmpe_list):
-                for j, gmpe in enumerate(self.gmpe_list):
-                    if i == j:
-                        continue
-                    data_i = outputs[i, :, :]
-                    data_j = outputs[j, :, :]
-                    distinctiveness[i, j] = float(np.sum(data_i < data_j) -
-                        np.sum(data_j < data_i)) / (nbs * nimts)
-            return distinctiveness
-        else:
-            distinctiveness = np.zeros([ngmpes, ngmpes, len(self.imts)])
-            for i, gmpe in enumerate(self.gmpe_list):
-                for j, gmpe in enumerate(self.gmpe_list):
-                    if i == j:
-                        continue
-                    for k in range(len(self.imts)):
-                        data_i = outputs[i, k, :]
-                        data_j = outputs[j, k, :]
-                        distinctiveness[i, j, k] =\
-                            float(np.sum(data_i < data_j) -
-                                  np.sum(data_j < data_i)) / nbs
-        return distinctiveness
+            return np.sum(counts, axis=2) / (nbs * nimts)
+        return counts / nbs
 
     def get_edr_values(self, bandwidth=0.01, multiplier=3.0):
         """
@@ -861,21 +1147,32 @@ class Residuals(object):
             edr_values[gmpe]["EDR"] = results[2]
         return edr_values
 
+    def _get_log_observations(self):
+        """
+        Returns the log observations of all records (in context order) for
+        each IMT, concatenating them from the contexts on the first call
+        """
+        if self.log_observations is None:
+            self.log_observations = {
+                imtx: np.log(_concatenate([context["Observations"][imtx]
+                                           for context in self.contexts]))
+                for imtx in self.imts}
+        return self.log_observations
+
     def _get_edr_gmpe_information(self, gmpe):
         """
         Extract the observed ground motions, expected and total standard
-        deviation for the GMPE (aggregating over all IMS)
+        deviation for the GMPE (aggregating over all IMS). The expected
+        values and standard deviations are those stored in `modelled` by
+        :meth:`get_residuals`
         """
-        obs = np.array([], dtype=float)
-        expected = np.array([], dtype=float)
-        stddev = np.array([], dtype=float)
-        for imtx in self.imts:
-            for context in self.contexts:
-                obs = np.hstack([obs, np.log(context["Observations"][imtx])])
-                expected = np.hstack([expected,
-                                      context["Expected"][gmpe][imtx]["Mean"]])
-                stddev = np.hstack([stddev,
-                                    context["Expected"][gmpe][imtx]["Total"]])
+        # The records of all contexts are concatenated per IMT
+        log_observations = self._get_log_observations()
+        obs = np.concatenate([log_observations[imtx] for imtx in self.imts])
+        expected = np.concatenate([self.modelled[gmpe][imtx]["Mean"]
+                                   for imtx in self.imts])
+        stddev = np.concatenate([self.modelled[gmpe][imtx]["Total"]
+                                 for imtx in self.imts])
         return obs, expected, stddev
 
     def _get_edr(self, obs, expected, stddev, bandwidth=0.01, multiplier=3.0):
@@ -889,22 +1186,31 @@ class Residuals(object):
         mu_d = obs - expected
         d1c = np.fabs(obs - (expected - (multiplier * stddev)))
         d2c = np.fabs(obs - (expected + (multiplier * stddev)))
-        dc_max = ceil(np.max(np.array([np.max(d1c), np.max(d2c)])))
-        num_d = len(np.arange(min_d, dc_max, bandwidth))
+        dc_max = ceil(max(d1c.max(), d2c.max()))
+        # Number of bins, as len(np.arange(min_d, dc_max, bandwidth))
+        num_d = int(ceil((dc_max - min_d) / bandwidth))
+        # Discretisation of the distance: bin centres d_val and the bin edges
+        # d_val -/+ min_d, where consecutive bins share an edge
+        d_val = min_d + bandwidth * np.arange(num_d)
+        d_edges = bandwidth * np.arange(num_d + 1)[:, np.newaxis]
         mde = np.zeros(nvals)
-        for iloc in range(0, num_d):
-            d_val = (min_d + (float(iloc) * bandwidth)) * np.ones(nvals)
-            d_1 = d_val - min_d
-            d_2 = d_val + min_d
-            p_1 = norm.cdf((d_1 - mu_d) / stddev) -\
-                norm.cdf((-d_1 - mu_d) / stddev)
-            p_2 = norm.cdf((d_2 - mu_d) / stddev) -\
-                norm.cdf((-d_2 - mu_d) / stddev)
-            mde += (p_2 - p_1) * d_val
+        # Broadcast over the bins for blocks of records, keeping the size of
+        # the [num_d + 1, block] probability arrays bounded
+        for start in range(0, nvals, EDR_BLOCK_SIZE):
+            block = slice(start, start + EDR_BLOCK_SIZE)
+            # Probability of |D| <= d at each bin edge for each record,
+            # Phi((d - mu) / s) - Phi((-d - mu) / s), is written using the
+            # symmetry of Phi as Phi((d - mu) / s) + Phi((d + mu) / s) - 1.
+            # The constant drops out of the differences between edges
+            z_edges = d_edges / stddev[block]
+            z_mu = mu_d[block] / stddev[block]
+            p_d = ndtr(z_edges - z_mu) + ndtr(z_edges + z_mu)
+            mde[block] = d_val.dot(np.diff(p_d, axis=0))
         inv_n = 1.0 / float(nvals)
-        mde_norm = np.sqrt(inv_n * np.sum(mde ** 2.))
-        edr = np.sqrt(kappa * inv_n * np.sum(mde ** 2.))
-        return mde_norm, np.sqrt(kappa), edr
+        # The sum of squares is shared by the MDE norm and the EDR
+        mde_norm = np.sqrt(inv_n * np.dot(mde, mde))
+        sqrt_kappa = np.sqrt(kappa)
+        return mde_norm, sqrt_kappa, sqrt_kappa * mde_norm
 
     def _get_edr_kappa(self, obs, expected):
         """
@@ -1030,7 +1336,7 @@ class SingleStationAnalysis(object):
         self.gmpe_list = _check_gsim_list(gmpe_list)
         self.imts = imts
         self.site_residuals = []
-        self.types = OrderedDict([(gmpe, {}) for gmpe in self.gmpe_list])
+        self.types = {gmpe: {} for gmpe in self.gmpe_list}
         for gmpe in self.gmpe_list:
             # if not gmpe in GSIM_LIST:
             #    raise ValueError("%s not supported in OpenQuake" % gmpe)
@@ -1077,47 +1383,48 @@ class SingleStationAnalysis(object):
         output_resid = []
 
         for t_resid in self.site_residuals:
-            resid = deepcopy(t_resid)
+            # The residuals are only read here, so share them with the
+            # original and give the copy its own site analysis dictionaries
+            resid = copy(t_resid)
+            resid.site_analysis = self._set_empty_dict()
+            resid.site_expected = self._set_empty_dict()
 
             for gmpe in self.gmpe_list:
                 for imtx in self.imts:
-                    if not resid.residuals[gmpe][imtx]:
+                    t_res = t_resid.residuals[gmpe][imtx]
+                    t_mod = t_resid.modelled[gmpe][imtx]
+                    site_res = resid.residuals[gmpe][imtx]
+                    sa = resid.site_analysis[gmpe][imtx]
+                    if not site_res:
                         continue
-                    n_events = len(resid.residuals[gmpe][imtx]["Total"])
-                    resid.site_analysis[gmpe][imtx]["events"] = n_events
-                    resid.site_analysis[gmpe][imtx]["Total"] = np.copy(
-                        t_resid.residuals[gmpe][imtx]["Total"])
-                    resid.site_analysis[gmpe][imtx]["Expected Total"] = \
-                        np.copy(t_resid.modelled[gmpe][imtx]["Total"])
-                    if not ("Intra event" in t_resid.residuals[gmpe][imtx]):
+                    n_events = len(site_res["Total"])
+                    sa["events"] = n_events
+                    sa["Total"] = np.copy(t_res["Total"])
+                    sa["Expected Total"] = np.copy(t_mod["Total"])
+                    if not ("Intra event" in t_res):
                         # GMPE has no within-event term - skip
                         continue
 
-                    resid.site_analysis[gmpe][imtx]["Intra event"] = np.copy(
-                        t_resid.residuals[gmpe][imtx]["Intra event"])
-                    resid.site_analysis[gmpe][imtx]["Inter event"] = np.copy(
-                        t_resid.residuals[gmpe][imtx]["Inter event"])
-
-                    delta_s2ss = self._get_delta_s2ss(
-                        resid.residuals[gmpe][imtx]["Intra event"],
-                        n_events)
-                    delta_woes = \
-                        resid.site_analysis[gmpe][imtx]["Intra event"] - \
-                        delta_s2ss
-                    resid.site_analysis[gmpe][imtx]["dS2ss"] = delta_s2ss
-                    resid.site_analysis[gmpe][imtx]["dWo,es"] = delta_woes
-
-                    resid.site_analysis[gmpe][imtx]["phi_ss,s"] = \
-                        self._get_single_station_phi(
-                            resid.residuals[gmpe][imtx]["Intra event"],
-                            delta_s2ss,
-                            n_events)
+                    sa["Intra event"] = np.copy(t_res["Intra event"])
+                    sa["Inter event"] = np.copy(t_res["Inter event"])
+
+                    if njit is not None:
+                        delta_s2ss, phi_ss = _site_term_and_phi(
+                            site_res["Intra event"])
+                    else:
+                        delta_s2ss = self._get_delta_s2ss(
+                            site_res["Intra event"], n_events)
+                        phi_ss = self._get_single_station_phi(
+                            site_res["Intra event"], delta_s2ss, n_events)
+                    delta_woes = sa["Intra event"] - delta_s2ss
+                    sa["dS2ss"] = delta_s2ss
+                    sa["dWo,es"] = delta_woes
+
+                    sa["phi_ss,s"] = phi_ss
                     # Get expected values too
 
-                    resid.site_analysis[gmpe][imtx]["Expected Inter"] =\
-                        np.copy(t_resid.modelled[gmpe][imtx]["Inter event"])
-                    resid.site_analysis[gmpe][imtx]["Expected Intra"] =\
-                        np.copy(t_resid.modelled[gmpe][imtx]["Intra event"])
+                    sa["Expected Inter"] = np.copy(t_mod["Inter event"])
+                    sa["Expected Intra"] = np.copy(t_mod["Intra event"])
             output_resid.append(resid)
         self.site_residuals = output_resid
         return self.get_total_phi_ss(pretty_print, filename)
@@ -1163,22 +1470,25 @@ class SingleStationAnalysis(object):
                           "random effects residuals" % (str(gmpe), str(imtx)))
                     continue
                 n_events = []
-                numerator_sum = 0.0
+                diffs = []
                 d2ss = []
                 for iloc, resid in enumerate(self.site_residuals):
-                    d2ss.append(resid.site_analysis[gmpe][imtx]["dS2ss"])
-                    n_events.append(resid.site_analysis[gmpe][imtx]["events"])
-                    numerator_sum += np.sum((
-                        resid.site_analysis[gmpe][imtx]["Intra event"] -
-                        resid.site_analysis[gmpe][imtx]["dS2ss"]) ** 2.)
+                    sa = resid.site_analysis[gmpe][imtx]
+                    d2ss.append(sa["dS2ss"])
+                    n_events.append(sa["events"])
+                    diffs.append(sa["Intra event"] - sa["dS2ss"])
                     if pretty_print:
                         print("Site ID, %s, dS2Ss, %12.8f, "
                               "phiss_s, %12.8f, Num Records, %s" % (
                               self.site_ids[iloc],
-                              resid.site_analysis[gmpe][imtx]["dS2ss"],
-                              resid.site_analysis[gmpe][imtx]["phi_ss,s"],
-                              resid.site_analysis[gmpe][imtx]["events"]),
+                              sa["dS2ss"],
+                              sa["phi_ss,s"],
+                              sa["events"]),
                               file=fid)
+                # Sum of squares of the within-event residuals about the site
+                # terms, taken over all sites at once
+                diffs = np.concatenate(diffs)
+                numerator_sum = np.dot(diffs, diffs)
                 d2ss = np.array(d2ss)
                 phi_s2ss[gmpe][imtx] = {"Mean": np.mean(d2ss),
                                         "StdDev": np.std(d2ss)}
@@ -5,6 +5,11 @@ import os
 import sys
 import shutil
 import unittest
+from unittest import mock
+import numpy as np
+from math import ceil
+from scipy.linalg import cho_factor, cho_solve
+from scipy.stats import norm
 from smtk.parsers.esm_flatfile_parser import ESMFlatfileParser
 import smtk.residuals.gmpe_residuals as res
 
@@ -98,6 +103,12 @@ class ResidualsTestCase(unittest.TestCase):
                         len(res_dict[gsim][imt]["Intra event"]), 41)
                 self.assertEqual(
                         len(res_dict[gsim][imt]["Total"]), 41)
+                for res_type in res_dict[gsim][imt]:
+                    # Per-context residuals are concatenated into 1D arrays
+                    self.assertIsInstance(res_dict[gsim][imt][res_type],
+                                          np.ndarray)
+                    self.assertEqual(res_dict[gsim][imt][res_type].dtype,
+                                     np.float64)
 
     def test_residuals_execution(self):
         """
@@ -135,6 +146,82 @@ class ResidualsTestCase(unittest.TestCase):
         self._check_residual_dictionary_correctness(multi_llh.residuals)
         multi_llh.get_multivariate_loglikelihood_values()
 
+    def test_multivariate_llh_dense_equivalence(self):
+        """
+        Tests that the event-wise multivariate llh matches the value obtained
+        from the full covariance matrix
+        """
+        multi_llh = res.Residuals(self.gsims, self.imts)
+        multi_llh.get_residuals(self.database, component="Geometric")
+        for gsim in self.gsims:
+            for imtx in self.imts:
+                observations, v_mat, expected_mat, neqs, nrecs =\
+                    res._build_matrices(multi_llh.contexts, gsim, imtx)
+                b_mat = observations - expected_mat
+                # V is symmetric positive definite, so use its Cholesky factor
+                # for both the log-determinant and the solve
+                c_mat, low = cho_factor(v_mat, lower=True)
+                logdetv = 2.0 * np.sum(np.log(np.diag(c_mat)))
+                expected_llh = (float(nrecs) * np.log(2.0 * np.pi) +
+                                logdetv +
+                                b_mat.dot(cho_solve((c_mat, low), b_mat))) / 2.
+                self.assertAlmostEqual(
+                    res.get_multivariate_ll(multi_llh.contexts, gsim, imtx),
+                    expected_llh, 7)
+
+    def test_multivariate_llh_imts_equivalence(self):
+        """
+        Tests that the multivariate llh evaluated for all IMTs together
+        matches the values for each IMT separately
+        """
+        multi_llh = res.Residuals(self.gsims, self.imts)
+        multi_llh.get_residuals(self.database, component="Geometric")
+        for gsim in self.gsims:
+            np.testing.assert_array_almost_equal(
+                res.get_multivariate_ll_imts(multi_llh.contexts, gsim,
+                                             self.imts),
+                [res.get_multivariate_ll(multi_llh.contexts, gsim, imtx)
+                 for imtx in self.imts], 7)
+
+    def test_bootstrap_llh_batch_execution(self):
+        """
+        Tests execution of the parallel multivariate llh bootstrap - not
+        correctness of values
+        """
+        multi_llh = res.Residuals(self.gsims, self.imts)
+        multi_llh.get_residuals(self.database, component="Geometric")
+        outputs = res.bootstrap_llh_batch(4, multi_llh.contexts,
+                                          multi_llh.gmpe_list,
+                                          multi_llh.imts,
+                                          concurrent_tasks=2)
+        self.assertEqual(outputs.shape, (2, 2, 4))
+        self.assertTrue(np.all(np.isfinite(outputs)))
+
+    def test_bootstrap_multivariate_llh_parallel_execution(self):
+        """
+        Tests execution of the parallelised multivariate llh bootstrap - not
+        correctness of values
+        """
+        multi_llh = res.Residuals(self.gsims, self.imts)
+        multi_llh.get_residuals(self.database, component="Geometric")
+        distinctiveness, outputs = \
+            multi_llh.bootstrap_multivariate_llhvalues(4, parallelize=True,
+                                                       concurrent_tasks=2)
+        self.assertEqual(outputs.shape, (2, 2, 4))
+        self.assertEqual(distinctiveness.shape, (2, 2, 2))
+
+    def test_bootstrap_multivariate_llh_seed(self):
+        """
+        Tests that a seeded bootstrap gives the same samples whether or not
+        it is run in parallel
+        """
+        multi_llh = res.Residuals(self.gsims, self.imts)
+        multi_llh.get_residuals(self.database, component="Geometric")
+        _, serial = multi_llh.bootstrap_multivariate_llhvalues(4, seed=42)
+        _, parallel = multi_llh.bootstrap_multivariate_llhvalues(
+            4, parallelize=True, concurrent_tasks=2, seed=42)
+        np.testing.assert_array_almost_equal(serial, parallel)
+
     def test_edr_execution(self):
         """
         Tests execution of EDR - not correctness of values
@@ -199,6 +286,140 @@ class ResidualsTestCase(unittest.TestCase):
         shutil.rmtree(cls.out_location)
 
 
+def _reference_edr(residuals, obs, expected, stddev, bandwidth=0.01,
+                   multiplier=3.0):
+    """
+    Per-bin loop implementation of the EDR (Kale & Akkar, 2013), used as the
+    reference for :meth:`smtk.residuals.gmpe_residuals.Residuals._get_edr`
+    """
+    nvals = len(obs)
+    min_d = bandwidth / 2.
+    kappa = residuals._get_edr_kappa(obs, expected)
+    mu_d = obs - expected
+    d1c = np.fabs(obs - (expected - (multiplier * stddev)))
+    d2c = np.fabs(obs - (expected + (multiplier * stddev)))
+    dc_max = ceil(np.max(np.array([np.max(d1c), np.max(d2c)])))
+    num_d = len(np.arange(min_d, dc_max, bandwidth))
+    mde = np.zeros(nvals)
+    for iloc in range(0, num_d):
+        d_val = (min_d + (float(iloc) * bandwidth)) * np.ones(nvals)
+        d_1 = d_val - min_d
+        d_2 = d_val + min_d
+        p_1 = norm.cdf((d_1 - mu_d) / stddev) -\
+            norm.cdf((-d_1 - mu_d) / stddev)
+        p_2 = norm.cdf((d_2 - mu_d) / stddev) -\
+            norm.cdf((-d_2 - mu_d) / stddev)
+        mde += (p_2 - p_1) * d_val
+    inv_n = 1.0 / float(nvals)
+    mde_norm = np.sqrt(inv_n * np.sum(mde ** 2.))
+    edr = np.sqrt(kappa * inv_n * np.sum(mde ** 2.))
+    return mde_norm, np.sqrt(kappa), edr
+
+
+class ResidualsKernelTestCase(unittest.TestCase):
+    """
+    Tests the array kernels of the residuals module against the reference
+    implementations, using fixed arrays rather than a database
+    """
+
+    def test_distinctiveness(self):
+        """
+        Tests the distinctiveness index against values counted by hand for a
+        set of bootstrap outputs with ties, for the counting kernel (compiled
+        with numba when available) and the numpy broadcast
+        """
+        residuals = res.Residuals([], ["PGA", "SA(1.0)"])
+        # Outputs of 3 GMPEs, 2 IMTs and 4 bootstraps
+        outputs = np.array([[[1., 2., 3., 4.], [5., 5., 5., 5.]],
+                            [[2., 2., 1., 4.], [4., 4., 5., 5.]],
+                            [[0., 3., 3., 5.], [5., 5., 5., 5.]]])
+        expected = np.array([[[0.0, 0.0], [0.0, -0.5], [0.25, 0.0]],
+                             [[0.0, 0.5], [0.0, 0.0], [0.5, 0.5]],
+                             [[-0.25, 0.0], [-0.5, -0.5], [0.0, 0.0]]])
+        expected_sum = np.array([[0.0, -0.25, 0.125],
+                                 [0.25, 0.0, 0.5],
+                                 [-0.125, -0.5, 0.0]])
+        np.testing.assert_array_equal(res._distinctiveness_counts(outputs),
+                                      4.0 * expected)
+        for use_numba in (True, False):
+            with mock.patch.object(res, "njit",
+                                   res.njit if use_numba else None):
+                np.testing.assert_array_almost_equal(
+                    residuals.get_distinctiveness(outputs, 4, False),
+                    expected)
+                np.testing.assert_array_almost_equal(
+                    residuals.get_distinctiveness(outputs, 4, True),
+                    expected_sum)
+
+    def test_edr_against_reference(self):
+        """
+        Tests the vectorised EDR against the per-bin loop, including a number
+        of records larger than the block size
+        """
+        residuals = res.Residuals([], [])
+        rng = np.random.RandomState(1000)
+        for nvals in (50, res.EDR_BLOCK_SIZE + 537):
+            expected = rng.normal(-2.0, 1.0, nvals)
+            obs = expected + rng.normal(0.2, 0.8, nvals)
+            stddev = rng.uniform(0.5, 0.9, nvals)
+            for bandwidth in (0.01, 0.05):
+                np.testing.assert_allclose(
+                    residuals._get_edr(obs, expected, stddev, bandwidth),
+                    _reference_edr(residuals, obs, expected, stddev,
+                                   bandwidth),
+                    rtol=1.0E-10)
+
+    def test_random_effects_residuals(self):
+        """
+        Tests that the loop kernel of the random effects residuals (compiled
+        with numba when available) matches the numpy implementation, including
+        a single inter-event sigma and zero inter- and intra-event sigmas
+        """
+        residuals = res.Residuals([], [])
+        obs = np.array([-1.2, -0.8, -1.5, -0.9])
+        mean = np.array([-1.0, -1.1, -1.3, -1.0])
+        sigmas = [(np.array([0.3, 0.3, 0.3, 0.3]),
+                   np.array([0.5, 0.6, 0.55, 0.7])),
+                  (np.array([0.3]), np.array([0.5, 0.6, 0.55, 0.7])),
+                  (np.array([0.35, 0.4, 0.3, 0.45]),
+                   np.array([0.5, 0.6, 0.55, 0.7])),
+                  (np.zeros(4), np.array([0.5, 0.6, 0.55, 0.7])),
+                  (np.zeros(4), np.zeros(4))]
+        for inter, intra in sigmas:
+            for normalise in (True, False):
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    kernel = residuals._get_random_effects_residuals(
+                        obs, mean, inter, intra, normalise)
+                    with mock.patch.object(res, "njit", None):
+                        numpy_res = residuals._get_random_effects_residuals(
+                            obs, mean, inter, intra, normalise)
+                for kernel_res, expected_res in zip(kernel, numpy_res):
+                    np.testing.assert_allclose(kernel_res, expected_res,
+                                               rtol=1.0E-12, atol=1.0E-14)
+
+    def test_site_term_and_phi(self):
+        """
+        Tests that the single-pass site term and single-station phi match the
+        separate calculations, including a site with a single record
+        """
+        ssa = res.SingleStationAnalysis([], [], [])
+        intra_events = [np.array([0.3, -0.2, 0.5, 0.1, -0.4]), np.array([0.3])]
+        for intra_event in intra_events:
+            n_events = len(intra_event)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                delta_s2ss, phi_ss = res._site_term_and_phi(intra_event)
+                expected_delta_s2ss = ssa._get_delta_s2ss(intra_event,
+                                                          n_events)
+                expected_phi_ss = ssa._get_single_station_phi(
+                    intra_event, expected_delta_s2ss, n_events)
+            self.assertAlmostEqual(delta_s2ss, expected_delta_s2ss, 12)
+            if n_events == 1:
+                self.assertTrue(np.isnan(phi_ss))
+                self.assertTrue(np.isnan(expected_phi_ss))
+            else:
+                self.assertAlmostEqual(phi_ss, expected_phi_ss, 12)
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()